@@ -2,7 +2,7 @@ from dateutil import tz
 
 
 # Timers
-timer = 30  # seconds
+timer = 60  # seconds, WinMeteo writes one row per minute
 error_timer = 120  # seconds
 kill_timer = 180  # seconds
 wait_for_kill = 20  # seconds
@@ -13,6 +13,8 @@ influxdb_token = 'ABCD123456789QWERTZUIOP'
 influxdb_org = 'org'
 influxdb_bucket = 'bucket'
 influxdb_measurement = 'winmeteo'
+influxdb_batch_size = 5000  # points
+influxdb_flush_interval = 10_000  # milliseconds
 
 # DBF file path
 dbf_path = 'C:/WinMeteo/Data/meteo.DBF'
@@ -1,20 +1,132 @@
+import atexit
+import logging
+import math
+import mmap
+import os
+import queue
+import signal
+import struct
 import subprocess
+import sys
+import threading
 import time
 from datetime import datetime, timedelta
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from typing import Any, Callable
 
 import psutil
 
-from dbfread.dbf import DBF
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import WriteOptions
 
 from meteoconfig import *
 
 
+logger = logging.getLogger("meteoflux")
+
 # InfluxDB timezone is always UTC
 utc_zone = tz.tzutc()
 
+# Measurement name escaped for line protocol
+escaped_measurement = influxdb_measurement.translate(str.maketrans({
+    ',': r'\,',
+    ' ': r'\ ',
+    '\n': r'\n',
+    '\t': r'\t',
+    '\r': r'\r',
+}))
+
+# Query for the last timestamp in InfluxDB, bucket, measurement and range start are passed as parameters
+LAST_TIMESTAMP_QUERY = 'from(bucket: params.bucket)' \
+                       '  |> range(start: params.start)' \
+                       '  |> filter(fn: (r) => r["_measurement"] == params.measurement)' \
+                       '  |> last()'
+
+# Time ranges searched for the last timestamp in InfluxDB, from the narrowest one
+LAST_TIMESTAMP_RANGES = (timedelta(days=-1), timedelta(days=-7), timedelta(days=-30), timedelta(days=-365))
+
+# (header length, record length, columns) of DBF file, parsed once and reused by following polls
+dbf_layout = None
+
+# Number of records at the start of DBF file already present in InfluxDB, following polls skip them
+last_record_count = 0
+
+# Oldest timestamp in ns of rows which could not be written to InfluxDB, set by on_write_error
+failed_timestamp_ns = None
+failed_timestamp_lock = threading.Lock()
+
+# DBF columns with timestamp of the row
+TIMESTAMP_FIELDS: frozenset[str] = frozenset({"DAT", "CAS"})
+
+# DBF columns not written to InfluxDB
+SKIP_FIELDS: frozenset[str] = frozenset({
+    "DAT", "CAS", "EX", "RESETCNT", "RESETTYP", "_NullFlags",  # system columns
+    "PWD_BL",  # currently not used column
+})
+
+# DBF column -> InfluxDB field name
+FIELD_MAP: dict[str, str] = {
+    "VLVZD": "humi",
+    "TEP2M": "temp",
+    "TEP2M_I": "temp_min",
+    "TEP2M_X": "temp_max",
+    "TLAK": "press",
+    "TLAK_M": "press_sea",
+    "SRAZKY": "rain",
+    "RYCHV": "wind_speed",
+    "SMERV": "wind_dir",
+    "RYCHV_P": "wind_speed_avg",
+    "SMERV_P": "wind_dir_avg",
+    "RYCHV_X": "wind_speed_max",
+    "SMERV_X": "wind_dir_max",
+    "CASV_X": "wind_time_max",
+    "NABAT_E": "volt_exp",
+    "NABAT": "volt",
+    "NABAT_I": "volt_min",
+    "PWD_V01": "pwd_visibility",
+    "PWD_V10": "pwd_visibility_10m",
+    "PWD_P01": "pwd_pw_code",
+    "PWD_P15": "pwd_pw_code_15m",
+    "PWD_WI": "pwd_water_intensity",
+    "PWD_WS": "pwd_water_sum",
+    "PWD_SS": "pwd_snow_sum",
+    "PWD_T": "pwd_temp",
+    "PWD_ERR": "pwd_error",
+}
+
+# DBF column -> (min, max) valid value, values outside of range are not written
+FIELD_LIMITS: dict[str, tuple[float, float]] = {
+    "PWD_V01": (0, 20000),
+    "PWD_V10": (0, 20000),
+    "PWD_P01": (0, float("inf")),
+    "PWD_P15": (0, float("inf")),
+    "PWD_WI": (0, float("inf")),
+    "PWD_WS": (0, float("inf")),
+    "PWD_SS": (0, float("inf")),
+    "PWD_T": (-100, 100),
+}
+
+
+def setup_logging() -> None:
+    """
+    Configures logging, records are queued and written to console by background thread, so loop is not blocked by I/O
+    :return: None
+    """
+    log_queue = queue.SimpleQueue()
+    console_handler = logging.StreamHandler(sys.stdout)  # same stream as print used before
+    console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+    listener = QueueListener(log_queue, console_handler)
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(logging.INFO)
+
+    listener.start()
+    # Registered first, so it runs last and writes out records logged by other exit handlers
+    atexit.register(listener.stop)
+
 
 def get_patched_dst_tz(base_timezone: tz.tzfile) -> tz.tzoffset:
     """
@@ -30,18 +142,48 @@ def get_patched_dst_tz(base_timezone: tz.tzfile) -> tz.tzoffset:
         return base_timezone
 
 
+@lru_cache(maxsize=64)
+def parse_date(dat: bytes) -> tuple[int, int, int]:
+    """
+    Parses DAT column of DBF row, results are cached as all rows of one day share the same date
+    :param dat: raw date in YYYYMMDD or YYYY-MM-DD format
+    :return: (year, month, day)
+    """
+    dat = dat.replace(b'-', b'')
+    return int(dat[0:4]), int(dat[4:6]), int(dat[6:8])
+
+
+def parse_timestamp(dat: bytes, cas: bytes, timezone) -> datetime:
+    """
+    Parses timestamp of DBF row, much faster than strptime as the format is always fixed
+    :param dat: raw DAT column of the row, date in YYYYMMDD or YYYY-MM-DD format
+    :param cas: raw CAS column of the row, time in HH:MM format
+    :param timezone: timezone of the timestamp
+    :return: timezone aware timestamp
+    """
+    return datetime(*parse_date(dat), int(cas[0:2]), int(cas[3:5]), tzinfo=timezone)
+
+
+def timestamp_to_ns(timestamp: datetime) -> int:
+    """
+    Converts timestamp to nanoseconds since epoch, as used by InfluxDB
+    :param timestamp: timezone aware timestamp, WinMeteo has minute resolution, so whole seconds are exact
+    :return: nanoseconds since epoch
+    """
+    return int(timestamp.timestamp()) * 1_000_000_000
+
+
 def get_last_timestamp(influx_client) -> datetime | None:
     """
-    Get last timestamp from InfluxDB
+    Get last timestamp from InfluxDB.
+    Narrow time ranges are searched first, so InfluxDB does not have to scan whole year of data.
     :param influx_client: initialized InfluxDB client
     :return: last timestamp or None if no data are present in InfluxDB
     """
-    query = f'from(bucket: "{influxdb_bucket}")' \
-            f'  |> range(start: -1y)' \
-            f'  |> filter(fn: (r) => r["_measurement"] == "{influxdb_measurement}")' \
-            f'  |> last()'
-    tables = influx_client.query_api().query(query, org=influxdb_org)
-    if tables:
+    query_api = influx_client.query_api()
+    for start in LAST_TIMESTAMP_RANGES:
+        params = {"bucket": influxdb_bucket, "start": start, "measurement": influxdb_measurement}
+        tables = query_api.query(LAST_TIMESTAMP_QUERY, org=influxdb_org, params=params)
         for table in tables:
             for record in table.records:
                 last_time = record.get_time().replace(tzinfo=utc_zone)
@@ -49,121 +191,261 @@ def get_last_timestamp(influx_client) -> datetime | None:
     return None
 
 
+def on_write_error(conf, data, exception) -> None:
+    """
+    Reports batch which could not be written to InfluxDB even after all retries.
+    Oldest timestamp of the batch is remembered, so the main loop can read its rows from DBF file again.
+    Called from the background thread of the batching write API.
+    :param conf: (bucket, org, precision) of the failed batch
+    :param data: line protocol data of the failed batch
+    :param exception: exception raised by the last attempt
+    :return: None
+    """
+    global failed_timestamp_ns
+
+    logger.error(f"Failed to write batch to InfluxDB: {exception}")
+    if isinstance(data, bytes):
+        data = data.decode()
+    # Every line ends with timestamp of the row in ns
+    oldest_timestamp_ns = min(int(line.rsplit(' ', 1)[1]) for line in data.splitlines() if line)
+    with failed_timestamp_lock:
+        if failed_timestamp_ns is None or oldest_timestamp_ns < failed_timestamp_ns:
+            failed_timestamp_ns = oldest_timestamp_ns
+
+
+def pop_failed_timestamp() -> datetime | None:
+    """
+    Gets oldest timestamp of rows which could not be written to InfluxDB since the last call
+    :return: timestamp or None if all writes succeeded
+    """
+    global failed_timestamp_ns
+
+    with failed_timestamp_lock:
+        timestamp_ns, failed_timestamp_ns = failed_timestamp_ns, None
+    if timestamp_ns is None:
+        return None
+    return datetime.fromtimestamp(timestamp_ns // 1_000_000_000, local_zone)
+
+
+def row_to_line_protocol(timestamp_ns, row) -> str | None:
+    """
+    Converts one row from DBF file into InfluxDB line protocol
+    :param timestamp_ns: timestamp of the row in ns
+    :param row: dictionary representing one row from DBF file
+    :return: line protocol string or None if the row has no field to write
+    """
+    fields = []
+    for key, value in row.items():
+        if key in SKIP_FIELDS:
+            continue
+        name = FIELD_MAP.get(key)
+        if name is None:
+            logger.error(f"Unknown column: {key}")
+            continue
+        if value is None or not math.isfinite(value):
+            continue  # empty field, NaN or infinity are not accepted by InfluxDB
+        limits = FIELD_LIMITS.get(key)
+        if limits is not None and not limits[0] <= value <= limits[1]:
+            continue  # invalid value
+
+        fields.append(f"{name}={value}")  # already decoded to float by the DBF reader
+    if not fields:
+        return None  # line protocol requires at least one field
+    return f"{escaped_measurement} {','.join(fields)} {timestamp_ns}"
+
+
 def write_to_influxdb(influx_write_api, data) -> None:
     """
     Writes data to InfluxDB
     :param influx_write_api: write API object of initialized InfluxDB client
-    :param data: list of dictionaries where each dictionary represents one row from DBF file
+    :param data: list of (timestamp in ns, row) tuples, where row is dictionary representing one row from DBF file
     :return: None
     """
-    print("Parsing into InfluxDB points...")
-    points = []
-
-    for row in data:
-        point = Point(influxdb_measurement)
-        for key, value in row.items():
-            match key:
-                case "DAT" | "CAS" | "EX" | "RESETCNT" | "RESETTYP" | "_NullFlags":
-                    continue  # system columns
-                case "PWD_BL":
-                    continue  # currently not used column
-                case "VLVZD":
-                    name = "humi"
-                case "TEP2M":
-                    name = "temp"
-                case "TEP2M_I":
-                    name = "temp_min"
-                case "TEP2M_X":
-                    name = "temp_max"
-                case "TLAK":
-                    name = "press"
-                case "TLAK_M":
-                    name = "press_sea"
-                case "SRAZKY":
-                    name = "rain"
-                case "RYCHV":
-                    name = "wind_speed"
-                case "SMERV":
-                    name = "wind_dir"
-                case "RYCHV_P":
-                    name = "wind_speed_avg"
-                case "SMERV_P":
-                    name = "wind_dir_avg"
-                case "RYCHV_X":
-                    name = "wind_speed_max"
-                case "SMERV_X":
-                    name = "wind_dir_max"
-                case "CASV_X":
-                    name = "wind_time_max"
-                case "NABAT_E":
-                    name = "volt_exp"
-                case "NABAT":
-                    name = "volt"
-                case "NABAT_I":
-                    name = "volt_min"
-                case "PWD_V01":
-                    if float(value) < 0 or float(value) > 20000:
-                        continue
-                    name = "pwd_visibility"
-                case "PWD_V10":
-                    if float(value) < 0 or float(value) > 20000:
-                        continue
-                    name = "pwd_visibility_10m"
-                case "PWD_P01":
-                    if float(value) < 0:
-                        continue
-                    name = "pwd_pw_code"
-                case "PWD_P15":
-                    if float(value) < 0:
-                        continue
-                    name = "pwd_pw_code_15m"
-                case "PWD_WI":
-                    if float(value) < 0:
-                        continue
-                    name = "pwd_water_intensity"
-                case "PWD_WS":
-                    if float(value) < 0:
-                        continue
-                    name = "pwd_water_sum"
-                case "PWD_SS":
-                    if float(value) < 0:
-                        continue
-                    name = "pwd_snow_sum"
-                case "PWD_T":
-                    name = "pwd_temp"
-                    value = float(value)
-                    if (value > 100) or (value < -100):
-                        continue
-                case "PWD_ERR":
-                    name = "pwd_error"
-                case _:
-                    print(f"ERROR: Unknown column: {key}")
-                    continue
-
-            point.field(name, float(value))
-        timestamp = datetime.strptime(f"{row['DAT']} {row['CAS']}", '%Y-%m-%d %H:%M')\
-            .replace(tzinfo=get_patched_dst_tz(local_zone))
-        point.time(timestamp.astimezone(utc_zone), WritePrecision.NS)
-        points.append(point)
-
-    print("Writing to InfluxDB...")
-    influx_write_api.write(bucket=influxdb_bucket, org=influxdb_org, record=points)
-
-
-def read_new_rows_from_dbf(last_timestamp) -> list[dict]:
-    """
-    Reads new rows from DBF file and returns them as a list of dictionaries
+    logger.debug("Parsing into InfluxDB line protocol...")
+    lines = [
+        line for line in (row_to_line_protocol(timestamp_ns, row) for timestamp_ns, row in data)
+        if line is not None
+    ]
+
+    logger.debug("Writing to InfluxDB...")
+    # Large backlog (e.g. after network outage) is written in chunks, InfluxDB handles huge requests poorly.
+    # This only matters for synchronous write API, batching one used by main() re-batches lines by batch_size anyway.
+    for start in range(0, len(lines), influxdb_batch_size):
+        influx_write_api.write(
+            bucket=influxdb_bucket,
+            org=influxdb_org,
+            record=lines[start:start + influxdb_batch_size],
+            write_precision=WritePrecision.NS
+        )
+
+
+def decode_number(value: bytes) -> float | None:
+    """
+    Decodes DBF numeric (N, F) field or other field storing number as ASCII text, same as dbfread does
+    :param value: raw field bytes
+    :return: decoded number or None if the field is empty
+    """
+    # Some files pad numbers with * instead of spaces
+    value = value.strip(b' \0').strip(b'*')
+    if not value:
+        return None
+    # Account for decimal comma
+    return float(value.replace(b',', b'.'))
+
+
+def decode_text(value: bytes) -> str:
+    """
+    Decodes DBF character (C) or date (D) field
+    :param value: raw field bytes
+    :return: decoded text without padding
+    """
+    return value.decode('cp1250', errors='replace').rstrip(' \0')
+
+
+# DBF field type -> decoder of raw field bytes, other field types are returned as raw bytes
+DBF_DECODERS: dict[str, Callable[[bytes], Any]] = {
+    'N': decode_number,
+    'F': decode_number,
+    'C': decode_text,
+    'D': decode_text,
+    'B': lambda value: struct.unpack('<d', value)[0] if len(value) == 8 else value,  # double in Visual FoxPro
+    'I': lambda value: float(struct.unpack('<i', value)[0]),
+}
+
+# DBF field types decoded to float by DBF_DECODERS, B only when it is 8 bytes long Visual FoxPro double
+NUMERIC_DBF_TYPES = frozenset({'N', 'F', 'B', 'I'})
+
+
+def read_dbf_header(dbf_map, reload=False) -> tuple[int, int, int, list[tuple[str, int, int, Callable[[bytes], Any]]]]:
+    """
+    Parses header of DBF file, column descriptors parsed by previous call are reused while the layout is unchanged
+    :param dbf_map: memory mapped DBF file
+    :param reload: parse column descriptors even if the layout seems unchanged
+    :return: (number of records, header length, record length, list of (name, offset, length, decoder) of columns)
+    """
+    global dbf_layout
+
+    num_records, header_length, record_length = struct.unpack_from('<IHH', dbf_map, 4)
+    if not reload and dbf_layout is not None and dbf_layout[:2] == (header_length, record_length):
+        return num_records, *dbf_layout
+
+    columns = []
+    offset = 1  # every record starts with deletion flag
+    # Field descriptors are 32 bytes long and are terminated by 0x0D
+    for pos in range(32, header_length - 31, 32):
+        if dbf_map[pos] == 0x0D:
+            break
+        name = dbf_map[pos:pos + 11].split(b'\0', 1)[0].decode('ascii')
+        field_type = chr(dbf_map[pos + 11])
+        length = dbf_map[pos + 16]
+        if name in TIMESTAMP_FIELDS:
+            columns.append((name, offset, length, bytes))  # parsed from raw bytes by parse_timestamp
+        elif name in FIELD_MAP:
+            # Written columns are decoded straight to float, the decoder is chosen once by field type
+            if field_type in NUMERIC_DBF_TYPES and (field_type != 'B' or length == 8):
+                decode = DBF_DECODERS[field_type]
+            else:
+                decode = decode_number  # text, or dBase B field storing memo index as ASCII number
+            columns.append((name, offset, length, decode))
+        elif name not in SKIP_FIELDS:
+            columns.append((name, offset, length, DBF_DECODERS.get(field_type, bytes)))  # unknown column
+        # other skipped columns are never written, so they are not even read
+        offset += length
+
+    dbf_layout = (header_length, record_length, columns)
+    return num_records, *dbf_layout
+
+
+def read_new_rows_from_dbf(last_timestamp) -> tuple[list[tuple[int, dict]], datetime]:
+    """
+    Reads new rows from DBF file and returns them together with their timestamps in ns, as written to InfluxDB.
+    Records read by previous calls are skipped, WinMeteo only appends new records to the end of the file.
+    The file is memory mapped and only new records are decoded, columns in SKIP_FIELDS are left out,
+    except DAT and CAS, which are returned as raw bytes.
     :param last_timestamp: only rows with timestamp greater than this will be returned
-    :return: list of dictionaries where each dictionary represents one row from DBF file
+    :return: (list of (timestamp in ns, row) tuples, where row is dictionary representing one row from DBF file,
+              newest timestamp of returned rows or last_timestamp if there are no new rows)
     """
-    table = DBF(dbf_path, load=True)
-    new_rows = []
-    for record in table:
-        record_time = datetime.strptime(f"{record['DAT']} {record['CAS']}", '%Y-%m-%d %H:%M')\
-            .replace(tzinfo=get_patched_dst_tz(local_zone))
-        if record_time > last_timestamp:
-            new_rows.append(record)
-    return new_rows
+    global last_record_count
+
+    with open(dbf_path, 'rb') as dbf_file, mmap.mmap(dbf_file.fileno(), 0, access=mmap.ACCESS_READ) as dbf_map:
+        num_records, header_length, record_length, columns = read_dbf_header(dbf_map)
+        if num_records < last_record_count:
+            logger.warning("DBF file has less records than before, reading it from the start...")
+            last_record_count = 0
+            num_records, header_length, record_length, columns = read_dbf_header(dbf_map, reload=True)
+        # Ignore record which is still being written
+        num_records = min(num_records, (len(dbf_map) - header_length) // record_length)
+
+        timezone = get_patched_dst_tz(local_zone)
+        last_timestamp_ns = timestamp_to_ns(last_timestamp)
+        newest_timestamp_ns = last_timestamp_ns
+        new_rows = []
+        record_count = last_record_count
+        for index in range(last_record_count, num_records):
+            base = header_length + index * record_length
+            if dbf_map[base] == 0x2A:  # '*' marks deleted record
+                if not new_rows:
+                    record_count += 1
+                continue
+            record = {
+                name: decode(dbf_map[base + offset:base + offset + length])
+                for name, offset, length, decode in columns
+            }
+            record_time = timestamp_to_ns(parse_timestamp(record['DAT'], record['CAS'], timezone))
+            if record_time > last_timestamp_ns:
+                new_rows.append((record_time, record))
+                newest_timestamp_ns = max(newest_timestamp_ns, record_time)
+            elif not new_rows:
+                # Only records older than last timestamp are skipped next time, new ones are counted
+                # by the following call, once main() has moved last timestamp past them
+                record_count += 1
+
+    last_record_count = record_count
+    if not new_rows:
+        return new_rows, last_timestamp
+    return new_rows, datetime.fromtimestamp(newest_timestamp_ns // 1_000_000_000, local_zone)
+
+
+def reset_dbf_position() -> None:
+    """
+    Makes next read_new_rows_from_dbf call read DBF file from the start again
+    :return: None
+    """
+    global last_record_count
+    last_record_count = 0
+
+
+def is_process_running(process_name) -> bool:
+    """
+    Checks if process with given name is running
+    :param process_name: name of the executable, compared case-insensitively as Windows does
+    :return: True if at least one such process is running
+    """
+    # Single tasklist call filtered by Windows itself, psutil would have to inspect every running process
+    try:
+        result = subprocess.run(
+            ["tasklist", "/NH", "/FO", "CSV", "/FI", f"IMAGENAME eq {process_name}"],
+            capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning(f"tasklist failed, looking up {process_name} with psutil instead. Error: {e}")
+        return bool(find_processes(process_name))
+    # Matching processes are listed as "name","PID",..., otherwise only informational message is printed
+    return f'"{process_name.lower()}"' in result.stdout.lower()
+
+
+def find_processes(process_name) -> list[psutil.Process]:
+    """
+    Finds all processes with given name
+    :param process_name: name of the executable, compared case-insensitively as Windows does
+    :return: list of found processes
+    """
+    process_name = process_name.lower()
+    return [
+        proc for proc in psutil.process_iter(attrs=['name'])
+        if (proc.info['name'] or '').lower() == process_name
+    ]
 
 
 def start_winmeteo_if_not_running(process_name, process_path, working_dir) -> None:
@@ -174,9 +456,42 @@ def start_winmeteo_if_not_running(process_name, process_path, working_dir) -> No
     :param working_dir: working directory for the process
     :return: None
     """
-    if not any(proc.name() == process_name for proc in psutil.process_iter()):
+    if not is_process_running(process_name):
         subprocess.Popen(process_path, cwd=working_dir)
-        print(f"Started {process_name}.")
+        logger.info(f"Started {process_name}.")
+
+
+def watch_winmeteo(process_name) -> threading.Event:
+    """
+    Watches running WinMeteo processes in background thread
+    :param process_name: name of the executable
+    :return: event which is set once all watched processes have exited (immediately if none is running)
+    """
+    exited = threading.Event()
+    processes = find_processes(process_name)
+
+    def wait_for_exit():
+        psutil.wait_procs(processes)
+        exited.set()
+
+    threading.Thread(target=wait_for_exit, name=f"watch-{process_name}", daemon=True).start()
+    return exited
+
+
+def wait_for_event(event, timeout) -> None:
+    """
+    Waits until event is set or timeout elapses, in short time.sleep steps,
+    as Event.wait is not interrupted by Ctrl+C on Windows
+    :param event: event to wait for
+    :param timeout: maximum time in seconds to wait
+    :return: None
+    """
+    deadline = time.monotonic() + timeout
+    while not event.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(1, remaining))
 
 
 def kill_winmeteo(process_name, kill_time_limit) -> None:
@@ -186,61 +501,85 @@ def kill_winmeteo(process_name, kill_time_limit) -> None:
     :param kill_time_limit: maximum time in secods to wait for the process to terminate
     :return: None
     """
-    # Attempt to kill the process
-    process_exists = any(proc.name() == process_name for proc in psutil.process_iter())
-    if process_exists:
+    # Keep handles of the processes, so their termination can be awaited
+    processes = find_processes(process_name)
+    if processes:
         try:
             subprocess.run(["taskkill", "/f", "/im", process_name], check=True)
-            print(f"Attempted to kill {process_name}.")
+            logger.info(f"Attempted to kill {process_name}.")
         except subprocess.CalledProcessError as e:
-            print(f"Failed to terminate {process_name}. Error: {e}")
+            logger.error(f"Failed to terminate {process_name}. Error: {e}")
             return
     else:
-        print(f"Process {process_name} is not running.")
+        logger.info(f"Process {process_name} is not running.")
         return
 
-    # Check if the process has been killed, with a timeout
-    start_time = time.time()
-    while True:
-        process_exists = any(proc.name() == process_name for proc in psutil.process_iter())
-        if not process_exists:
-            print(f"Process {process_name} has been terminated successfully.")
-            break
-
-        if time.time() - start_time > kill_time_limit:
-            raise OSError(f"Failed to terminate process {process_name} within {kill_time_limit} seconds.")
-
-        time.sleep(1)
+    # Wait until the process is terminated (the OS signals its exit), with a timeout
+    _, alive = psutil.wait_procs(processes, timeout=kill_time_limit)
+    if alive:
+        raise OSError(f"Failed to terminate process {process_name} within {kill_time_limit} seconds.")
+    logger.info(f"Process {process_name} has been terminated successfully.")
 
 
 def main():
+    setup_logging()
+
     winmeteo_path_obj = Path(winmeteo_path)
     winmeteo_dir = winmeteo_path_obj.parent
     winmeteo_process = winmeteo_path_obj.name
 
     start_winmeteo_if_not_running(winmeteo_process, winmeteo_path, winmeteo_dir)
+    winmeteo_exited = watch_winmeteo(winmeteo_process)
+
+    # Exit through atexit handlers on Ctrl+Break as well, so pending batches are flushed.
+    # Closing the console window may still lose unflushed batch, Windows ends the process before the handler runs.
+    if hasattr(signal, 'SIGBREAK'):
+        signal.signal(signal.SIGBREAK, lambda signum, frame: sys.exit(0))
 
     connected = False
     last_timestamp = None
+    client = None
     write_api = None
 
     # Connect to InfluxDB
     while not connected:
         try:
-            # Connect to InfluxDB
+            # Connect to InfluxDB, the client is then kept for the whole run to reuse its connections
             client = InfluxDBClient(url=influxdb_url, token=influxdb_token, org=influxdb_org)
-            write_api = client.write_api(write_options=SYNCHRONOUS)
+            # Batching API writes on background thread, rows are sent in batches of influxdb_batch_size
+            write_api = client.write_api(
+                write_options=WriteOptions(
+                    batch_size=influxdb_batch_size,
+                    flush_interval=influxdb_flush_interval,
+                    jitter_interval=2_000,
+                    retry_interval=5_000,
+                    max_retries=3
+                ),
+                error_callback=on_write_error
+            )
 
             last_timestamp = get_last_timestamp(client) or datetime.min.replace(tzinfo=local_zone)
-            print(f"Last timestamp in InfluxDB: {last_timestamp}")
+            logger.info(f"Last timestamp in InfluxDB: {last_timestamp}")
 
             connected = True
+
+            # Flush pending batches on exit
+            atexit.register(client.close)
+            atexit.register(write_api.close)
         except Exception as e:  # noqa
-            print(f"ERROR: {e}")
-            print(f"Waiting for {error_timer} seconds before trying to connect again...")
+            logger.error(e)
+            # Release threads and sockets of the failed client
+            if write_api is not None:
+                write_api.close()
+                write_api = None
+            if client is not None:
+                client.close()
+                client = None
+            logger.info(f"Waiting for {error_timer} seconds before trying to connect again...")
             time.sleep(error_timer)
 
     iterations = 0
+    last_dbf_stat = None
     zeros = 0
     restarts = 0
     last_restart = datetime.now()
@@ -250,39 +589,62 @@ def main():
     while True:
         try:
             iterations += 1
-            print("-" * 80)
-            print(f"STATS: Iteration: {iterations}, restarts: {restarts}, last (re)start: {last_restart}")
-
-            new_rows = read_new_rows_from_dbf(last_timestamp)
-            print(f"Found {len(new_rows)} new rows.")
+            logger.info("-" * 80)
+            logger.info(f"STATS: Iteration: {iterations}, restarts: {restarts}, last (re)start: {last_restart}")
+
+            # Rows of batches which failed in background are read again, so none of them is lost
+            failed_timestamp = pop_failed_timestamp()
+            if failed_timestamp is not None and failed_timestamp <= last_timestamp:
+                logger.warning(f"Writing rows since {failed_timestamp} failed, they will be written again.")
+                last_timestamp = failed_timestamp - timedelta(seconds=1)
+                reset_dbf_position()
+                last_dbf_stat = None  # read the file even if it has not changed
+
+            # WinMeteo appends rows to the file, so unchanged size and modification time mean no new rows
+            stat = os.stat(dbf_path)
+            dbf_stat = (stat.st_size, stat.st_mtime_ns)
+            if dbf_stat != last_dbf_stat:
+                new_rows, newest_timestamp = read_new_rows_from_dbf(last_timestamp)
+                logger.info(f"Found {len(new_rows)} new rows.")
+            else:
+                new_rows, newest_timestamp = [], last_timestamp
+                logger.info("DBF file has not changed.")
 
             if new_rows:
                 write_to_influxdb(write_api, new_rows)
-                last_timestamp = max(
-                    datetime.strptime(f"{row['DAT']} {row['CAS']}", '%Y-%m-%d %H:%M')
-                    .replace(tzinfo=get_patched_dst_tz(local_zone))
-                    for row in new_rows
-                )
-                print(f"Written {len(new_rows)} new rows to InfluxDB.")
+                last_timestamp = newest_timestamp
+                logger.info(f"Queued {len(new_rows)} new rows for writing to InfluxDB.")
                 zeros = 0
             else:
                 zeros += 1
-                print(f"No new rows found. Attempts: {zeros}/{max_zeros}")
+                logger.info(f"No new rows found. Attempts: {zeros}/{max_zeros}")
+            last_dbf_stat = dbf_stat  # not updated when reading or queueing rows raises, they are read again
 
+            # WinMeteo is restarted when it stops writing new rows or as soon as it exits
+            restart_reason = None
             if zeros >= max_zeros:
-                print(f"Maximum attempts count reached. Restarting WinMeteo...")
+                restart_reason = "Maximum attempts count reached"
+            elif winmeteo_exited.is_set():
+                restart_reason = f"Process {winmeteo_process} has exited"
+
+            if restart_reason:
+                logger.warning(f"{restart_reason}. Restarting WinMeteo...")
                 kill_winmeteo(winmeteo_process, wait_for_kill)
                 start_winmeteo_if_not_running(winmeteo_process, winmeteo_path, winmeteo_dir)
+                winmeteo_exited = watch_winmeteo(winmeteo_process)
                 restarts += 1
                 last_restart = datetime.now()
                 zeros = 0
         except Exception as e: # noqa
-            print(f"ERROR: {e}")
-            print(f"Waiting for {error_timer} seconds before trying again...")
+            logger.error(e)
+            logger.info(f"Waiting for {error_timer} seconds before trying again...")
             time.sleep(error_timer)
         else:
-            print(f"Sleeping for {timer} seconds...")
-            time.sleep(timer)  # Wait for X seconds before checking again
+            logger.info(f"Sleeping for {timer} seconds...")
+            if restart_reason:
+                time.sleep(timer)  # Wait for X seconds before checking again
+            else:
+                wait_for_event(winmeteo_exited, timer)  # Wait for X seconds or until WinMeteo exits
 
 
 if __name__ == '__main__':